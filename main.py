@@ -1,14 +1,38 @@
+import os
 import sys
+import json
+import time
+import mmap
+import struct
+import hashlib
+import hmac
+import secrets
+import argparse
+import shutil
+import tempfile
+import threading
+from array import array
+from contextlib import contextmanager
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import fitz  # PyMuPDF
 import math
+import multiprocessing
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                              QHBoxLayout, QLabel, QPushButton, QFileDialog, QScrollArea,
                              QInputDialog, QMessageBox, QComboBox, QTreeWidget, 
                              QTreeWidgetItem, QTabWidget, QGroupBox, QFormLayout,
                              QLineEdit, QSpinBox, QDoubleSpinBox, QRadioButton,
-                             QButtonGroup, QDialog, QCheckBox, QColorDialog)
-from PyQt5.QtCore import Qt, QPointF, QRectF, QPoint
-from PyQt5.QtGui import QImage, QPixmap, QPainter, QPen, QColor, QFont, QIcon, QCursor
+                             QButtonGroup, QDialog, QCheckBox, QColorDialog,
+                             QProgressDialog, QAbstractItemView, QStyle)
+from PyQt5.QtCore import Qt, QPointF, QRectF, QPoint, QEvent, QTimer
+from PyQt5.QtGui import (QImage, QPixmap, QPainter, QPen, QColor, QFont, QIcon, QCursor,
+                         QPainterPath, QPolygonF, QKeySequence, QMouseEvent, QKeyEvent)
 
 class Magnifier(QLabel):
     def __init__(self, parent, zoom_factor=2.5):
@@ -23,10 +47,10 @@ class Magnifier(QLabel):
         self.setStyleSheet("background-color: rgba(255, 255, 255, 180);")
         self.hide()
         
-    def update_magnifier(self, pos, source_pixmap, force_show=False):
+    def update_magnifier(self, pos, source_image, force_show=False):
         """Update magnifier position and content with centered cursor"""
         try:
-            if source_pixmap and not source_pixmap.isNull():
+            if source_image and not source_image.isNull():
                 # Calculate source rect size (accounting for zoom)
                 source_size = self.size / self.zoom_factor
                 
@@ -44,7 +68,7 @@ class Magnifier(QLabel):
                 
                 painter = QPainter(magnified)
                 painter.setRenderHint(QPainter.SmoothPixmapTransform)
-                painter.drawPixmap(target_rect, source_pixmap, source_rect)
+                painter.drawImage(target_rect, source_image, source_rect)
                 
                 # Draw crosshair at center
                 painter.setPen(QPen(QColor(0, 0, 0, 180), 1))
@@ -81,36 +105,1143 @@ class Magnifier(QLabel):
             self.setPixmap(QPixmap())
         self.hide()
 
+# Power of the calibration scale each geometric quantity is divided by
+SCALE_POWERS = {'Distance': 1, 'Area': 2}
+
+def polyline_length(points):
+    """Length of an open polyline given as (x, y) tuples"""
+    return sum(math.hypot(x2 - x1, y2 - y1)
+               for (x1, y1), (x2, y2) in zip(points, points[1:]))
+
+def polygon_area(points):
+    """Unsigned shoelace area of a closed polygon given as (x, y) tuples"""
+    n = len(points)
+    if n < 3:
+        return 0.0
+    area = sum(points[i][0] * points[(i + 1) % n][1] -
+               points[(i + 1) % n][0] * points[i][1]
+               for i in range(n))
+    return abs(area) / 2
+
+def ring_bounds(ring):
+    xs = [x for x, _ in ring]
+    ys = [y for _, y in ring]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def point_in_ring(x, y, ring):
+    """Even-odd ray cast test of a point against one ring"""
+    inside = False
+    n = len(ring)
+    for i in range(n):
+        x1, y1 = ring[i]
+        x2, y2 = ring[(i + 1) % n]
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+def shape_area(rings):
+    """Area of non-crossing rings under the even-odd rule, so nested rings alternate fill and hole"""
+    if len(rings) == 1:
+        return polygon_area(rings[0])
+    areas = np.array([polygon_area(ring) for ring in rings])
+    bounds = np.array([ring_bounds(ring) for ring in rings])
+    total = 0.0
+    for i, ring in enumerate(rings):
+        # Only larger rings whose bounds enclose this one can contain it
+        candidates = np.nonzero((areas > areas[i]) &
+                                (bounds[:, 0] <= bounds[i, 0]) & (bounds[:, 1] <= bounds[i, 1]) &
+                                (bounds[:, 2] >= bounds[i, 2]) & (bounds[:, 3] >= bounds[i, 3]))[0]
+        (x1, y1), (x2, y2) = ring[0], ring[1]
+        x, y = (x1 + x2) / 2, (y1 + y2) / 2
+        depth = sum(point_in_ring(x, y, rings[j]) for j in candidates)
+        total += -areas[i] if depth % 2 else areas[i]
+    return total
+
+def segments_cross(a, b, c, d):
+    """True if segments ab and cd intersect, including touching and collinear overlap"""
+    def orient(p, q, r):
+        value = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+        return (value > 0) - (value < 0)
+    
+    def on_segment(p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+    
+    o1, o2, o3, o4 = orient(a, b, c), orient(a, b, d), orient(c, d, a), orient(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and on_segment(a, b, c)) or (o2 == 0 and on_segment(a, b, d)) or
+            (o3 == 0 and on_segment(c, d, a)) or (o4 == 0 and on_segment(c, d, b)))
+
+def ring_self_intersects(ring):
+    """Sweep-line check for crossing edges in a closed ring
+
+    Edges are swept in order of their left end; each is tested only against
+    active edges whose x and y extents overlap it, so typical outlines cost
+    close to O(n log n) instead of testing every pair of edges.
+    """
+    n = len(ring)
+    if n < 4:
+        return False
+    edges = sorted(((min(ring[i][0], ring[(i + 1) % n][0]), i) for i in range(n)))
+    active = []
+    for xmin, i in edges:
+        a, b = ring[i], ring[(i + 1) % n]
+        ymin, ymax = min(a[1], b[1]), max(a[1], b[1])
+        active = [j for j in active if max(ring[j][0], ring[(j + 1) % n][0]) >= xmin]
+        for j in active:
+            if abs(i - j) in (1, n - 1):
+                continue  # Neighbouring edges share a vertex
+            c, d = ring[j], ring[(j + 1) % n]
+            if max(c[1], d[1]) >= ymin and min(c[1], d[1]) <= ymax and segments_cross(a, b, c, d):
+                return True
+        active.append(i)
+    return False
+
+def rings_to_path(rings):
+    path = QPainterPath()
+    path.setFillRule(Qt.OddEvenFill)
+    for ring in rings:
+        path.addPolygon(QPolygonF([QPointF(x, y) for x, y in ring]))
+        path.closeSubpath()
+    return path
+
+def path_to_rings(path):
+    rings = []
+    for polygon in path.toSubpathPolygons():
+        ring = [(point.x(), point.y()) for point in polygon]
+        if len(ring) > 1 and ring[0] == ring[-1]:
+            ring.pop()
+        if len(ring) >= 3:
+            rings.append(ring)
+    return rings
+
+def combine_areas(rings, other_rings, operation):
+    """Union or difference of two ring sets using Qt's path clipper; returns planar rings"""
+    path, other = rings_to_path(rings), rings_to_path(other_rings)
+    result = path.united(other) if operation == 'union' else path.subtracted(other)
+    return path_to_rings(result)
+
+RenderedPage = namedtuple('RenderedPage', 'samples width height stride alpha origin mode')
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'quantity_estimator')
+TILE_SIZE = 512
+
+# Render colour modes offered in the toolbar; 'auto' picks 'gray' for monochrome pages
+RENDER_MODES = {'Color': 'rgb', 'Grayscale': 'gray', '1-bit': 'mono', 'Auto': 'auto'}
+
+MONO_THRESHOLD = 200  # Gray levels below this become ink in 1-bit renders
+
+def row_bytes(pixels, mode):
+    """Bytes needed for a run of pixels in a render mode"""
+    if mode == 'mono':
+        return (pixels + 7) // 8
+    return pixels * (1 if mode == 'gray' else 3)
+
+def gray_rows(pix):
+    """2-D uint8 array view of a grayscale pixmap"""
+    array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    return array[:, :pix.width]
+
+def detect_render_mode(page):
+    """'gray' if a low resolution preview of the page has no real colour, else 'rgb'"""
+    pix = page.get_pixmap(matrix=fitz.Matrix(0.25, 0.25), alpha=False)
+    rgb = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    rgb = rgb[:, :pix.width * 3].reshape(pix.height, pix.width, 3).astype(np.int16)
+    colored = (rgb.max(axis=2) - rgb.min(axis=2)) > 24
+    return 'gray' if colored.mean() < 0.001 else 'rgb'
+
+def page_view_matrix(zoom, rotation):
+    """Matrix used to render a page at a zoom level and view rotation"""
+    matrix = fitz.Matrix(zoom, zoom)
+    if rotation != 0:
+        matrix.prerotate(rotation)
+    return matrix
+
+def render_page_data(page, zoom, rotation, tile=None, mode='rgb'):
+    """Render a page, or one TILE_SIZE tile of it, to raw RGB, gray or packed 1-bit samples"""
+    matrix = page_view_matrix(zoom, rotation)
+    clip = None
+    if tile is not None:
+        bounds = page.rect * matrix
+        x0 = bounds.x0 + tile[0] * TILE_SIZE
+        y0 = bounds.y0 + tile[1] * TILE_SIZE
+        clip = fitz.Rect(x0, y0, x0 + TILE_SIZE, y0 + TILE_SIZE) * ~matrix
+    if mode == 'rgb':
+        pix = page.get_pixmap(matrix=matrix, clip=clip)
+        return RenderedPage(pix.samples, pix.width, pix.height, pix.stride, bool(pix.alpha),
+                            (pix.x, pix.y), mode)
+    
+    pix = page.get_pixmap(matrix=matrix, clip=clip, colorspace=fitz.csGRAY, alpha=False)
+    if mode == 'mono':
+        bits = np.packbits(gray_rows(pix) >= MONO_THRESHOLD, axis=1)
+        return RenderedPage(bits.tobytes(), pix.width, pix.height, bits.shape[1], False,
+                            (pix.x, pix.y), mode)
+    return RenderedPage(pix.samples, pix.width, pix.height, pix.stride, False, (pix.x, pix.y), mode)
+
+def rendered_image(rendered):
+    """Wrap rendered samples in a QImage of the matching format without copying pixels"""
+    if rendered.mode == 'mono':
+        img = QImage(rendered.samples, rendered.width, rendered.height, rendered.stride, QImage.Format_Mono)
+        img.setColorTable([0xff000000, 0xffffffff])  # Detaches, but packed bits are tiny
+        return img
+    if rendered.mode == 'gray':
+        fmt = QImage.Format_Grayscale8
+    else:
+        fmt = QImage.Format_RGBA8888 if rendered.alpha else QImage.Format_RGB888
+    return QImage(rendered.samples, rendered.width, rendered.height, rendered.stride, fmt)
+
+def assemble_tiles(tiles, width, height, origin, mode):
+    """Copy [(x, y, tile)] into one contiguous render, keeping the tiles' render mode"""
+    rows = np.empty((height, row_bytes(width, mode)), dtype=np.uint8)
+    for x, y, tile in tiles:
+        start = row_bytes(x, mode)
+        rows[y:y + tile.height, start:start + tile.stride] = tile.rows()
+    return RenderedPage(rows.reshape(-1).data, width, height, rows.shape[1], False, origin, mode)
+
+def create_worker_pool(workers=None):
+    """Process pool for page work; spawned so workers never inherit the GUI's Qt state"""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+_worker_documents = {}  # Per-process cache of documents opened by pool workers, by file key
+
+def file_key(path):
+    """Identify a file by path, size and modification time so replaced files are reopened"""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def open_worker_document(key):
+    """Open a PDF once per worker process and file version, closing older versions of it"""
+    doc = _worker_documents.get(key)
+    if doc is None:
+        for stale in [k for k in _worker_documents if k[0] == key[0]]:
+            _worker_documents.pop(stale).close()
+        doc = _worker_documents[key] = fitz.open(key[0])
+    return doc
+
+def render_gray_array(page, zoom):
+    """Render a page to a 2-D uint8 grayscale array"""
+    return gray_rows(page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False))
+
+def changed_regions(mask, zoom, min_size=4):
+    """Bounding boxes of connected changes in a mask, in page units
+
+    Specks smaller than min_size pixels in both directions are dropped before
+    the remaining changes are dilated so nearby strokes merge into one box.
+    """
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    keep = (stats[:, cv2.CC_STAT_WIDTH] >= min_size) | (stats[:, cv2.CC_STAT_HEIGHT] >= min_size)
+    keep[0] = False  # Background
+    mask = cv2.dilate(keep[labels].astype(np.uint8) * 255, np.ones((5, 5), np.uint8))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    regions = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        regions.append((x / zoom, y / zoom, (x + w) / zoom, (y + h) / zoom))
+    return regions
+
+def render_page_task(key, page_index, zoom, rotation, tile=None, mode='rgb'):
+    """Render a page of a file_key in a worker process, resolving 'auto' to the page's detected mode"""
+    page = open_worker_document(key)[page_index]
+    if mode == 'auto':
+        mode = detect_render_mode(page)
+    return render_page_data(page, zoom, rotation, tile, mode)
+
+def text_index_task(key, page_index):
+    """Word boxes (x0, y0, x1, y1, word) of a page of a file_key, extracted in a worker process"""
+    return [tuple(word[:5]) for word in open_worker_document(key)[page_index].get_text('words')]
+
+def diff_revision_page(old_path, new_path, old_index, new_index, dpi, threshold=64):
+    """Pixel diff of one page pair; runs in a worker process"""
+    zoom = dpi / 72.0
+    old = render_gray_array(open_worker_document(file_key(old_path))[old_index], zoom)
+    new = render_gray_array(open_worker_document(file_key(new_path))[new_index], zoom)
+    
+    # Pad both renders to a common size so pages of different sizes still align
+    height = max(old.shape[0], new.shape[0])
+    width = max(old.shape[1], new.shape[1])
+    old = np.pad(old, ((0, height - old.shape[0]), (0, width - old.shape[1])), constant_values=255)
+    new = np.pad(new, ((0, height - new.shape[0]), (0, width - new.shape[1])), constant_values=255)
+    
+    changed = cv2.absdiff(old, new) > threshold
+    return new_index, {
+        'added': changed_regions(changed & (new < old), zoom),
+        'removed': changed_regions(changed & (new > old), zoom),
+    }
+
+def match_revision_pages(old_doc, new_doc):
+    """Pair pages of two revisions by page label when both are uniquely labelled, else by index
+
+    Returns (old index, new index) pairs; the old index is None for sheets
+    added in the new revision and the new index is None for deleted sheets.
+    """
+    old_labels = [page.get_label() for page in old_doc]
+    new_labels = [page.get_label() for page in new_doc]
+    if (all(old_labels) and all(new_labels) and
+            len(set(old_labels)) == len(old_labels) and len(set(new_labels)) == len(new_labels)):
+        lookup = {label: i for i, label in enumerate(old_labels)}
+        kept = set(new_labels)
+        return ([(lookup.get(label), i) for i, label in enumerate(new_labels)] +
+                [(i, None) for i, label in enumerate(old_labels) if label not in kept])
+    return ([(i if i < len(old_doc) else None, i) for i in range(len(new_doc))] +
+            [(i, None) for i in range(len(new_doc), len(old_doc))])
+
+def compare_revisions(old_path, new_path, dpi=100, workers=None):
+    """Yield (new page index, changes) for every page, diffing matched pages in a process pool
+
+    Sheets deleted from the old revision are yielded with a new page index
+    of None and their old page index under 'deleted'.
+    """
+    with fitz.open(old_path) as old_doc, fitz.open(new_path) as new_doc:
+        pairs = match_revision_pages(old_doc, new_doc)
+        page_rects = [tuple(page.rect) for page in new_doc]
+    
+    # Pages without a counterpart in the other revision are new or deleted sheets
+    for old_index, new_index in pairs:
+        if old_index is None:
+            yield new_index, {'added': [page_rects[new_index]], 'removed': []}
+        elif new_index is None:
+            yield None, {'added': [], 'removed': [], 'deleted': old_index}
+    
+    executor = create_worker_pool(workers)
+    try:
+        futures = [executor.submit(diff_revision_page, old_path, new_path, old_index, new_index, dpi)
+                   for old_index, new_index in pairs if None not in (old_index, new_index)]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def draw_markup(shape, type_name, rings, color, label):
+    """Draw one measurement as vector line work plus a text label"""
+    # Stored points follow the displayed (rotated) page; drawing uses unrotated space
+    page = shape.page
+    label_anchor = fitz.Point(rings[0][0][0] + 4, rings[0][0][1] - 4) * page.derotation_matrix
+    rings = [[fitz.Point(x, y) * page.derotation_matrix for x, y in ring] for ring in rings]
+    points = rings[0]
+    if type_name == 'Area' and len(points) >= 3:
+        for ring in rings:
+            shape.draw_polyline(ring + [ring[0]])
+        shape.finish(color=color, fill=color, width=1.5, fill_opacity=0.2, closePath=True, even_odd=True)
+    elif type_name == 'Count':
+        for point in points:
+            shape.draw_circle(point, 4)
+        shape.finish(color=color, fill=color, width=1)
+    elif len(points) >= 2:
+        shape.draw_polyline(points)
+        shape.finish(color=color, width=1.5)
+    if label:
+        shape.insert_text(label_anchor, label, fontsize=8, color=color, rotate=page.rotation)
+
+def burn_in_pages(pdf_path, first, last, markups, out_path):
+    """Copy pages first..last of a PDF with their markups drawn in; runs in a worker process"""
+    src = fitz.open(pdf_path)
+    doc = fitz.open()
+    doc.insert_pdf(src, from_page=first, to_page=last)
+    src.close()
+    for page_index, page_markups in markups.items():
+        page = doc[page_index - first]
+        shape = page.new_shape()
+        for type_name, rings, color, label in page_markups:
+            draw_markup(shape, type_name, rings, color, label)
+        shape.commit()
+    doc.save(out_path, garbage=3, deflate=True)
+    doc.close()
+    return out_path
+
+def export_markup_pdf(pdf_path, out_path, markups, chunk_size=25, workers=None):
+    """Burn markups into a copy of a PDF, drawing page chunks in parallel and merging in order
+
+    Yields the number of pages finished so far; markups maps page index to
+    (type, rings, rgb color, label) tuples. Each chunk is appended to the
+    output with an incremental save, so only one chunk is held in memory.
+    """
+    if os.path.exists(out_path) and os.path.samefile(pdf_path, out_path):
+        raise ValueError("Choose a different file; the drawing cannot be exported onto itself")
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    
+    # Build the output next to its destination and only replace it once complete
+    fd, temp_out = tempfile.mkstemp(suffix='.pdf', dir=os.path.dirname(os.path.abspath(out_path)))
+    os.close(fd)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir, create_worker_pool(workers) as executor:
+            futures = []
+            for first in range(0, page_count, chunk_size):
+                last = min(first + chunk_size, page_count) - 1
+                chunk_markups = {i: markups[i] for i in range(first, last + 1) if i in markups}
+                chunk_path = os.path.join(temp_dir, f"chunk_{first:06d}.pdf")
+                futures.append((last + 1, executor.submit(
+                    burn_in_pages, pdf_path, first, last, chunk_markups, chunk_path)))
+            
+            for index, (pages_done, future) in enumerate(futures):
+                chunk_path = future.result()
+                if index == 0:
+                    shutil.copyfile(chunk_path, temp_out)
+                else:
+                    with fitz.open(temp_out) as merged, fitz.open(chunk_path) as chunk:
+                        merged.insert_pdf(chunk)
+                        merged.saveIncr()
+                os.remove(chunk_path)
+                yield pages_done
+        os.replace(temp_out, out_path)
+    finally:
+        if os.path.exists(temp_out):
+            os.remove(temp_out)
+
+class Calibration:
+    """Page units per foot, versioned so cached quantities know when to recompute"""
+    def __init__(self, units_per_foot=1.0):
+        self._units_per_foot = units_per_foot
+        self.version = 0
+
+    @property
+    def units_per_foot(self):
+        return self._units_per_foot
+
+    @units_per_foot.setter
+    def units_per_foot(self, value):
+        if value != self._units_per_foot:
+            self._units_per_foot = value
+            self.version += 1
+
+    def to_real(self, raw, power):
+        """Convert a raw page-space quantity to feet (power 1) or sq.ft (power 2)"""
+        if not power:
+            return raw
+        return raw / (self._units_per_foot ** power)
+
+class PointArray:
+    """Compact sequence of (x, y) vertices backed by one flat array of doubles"""
+    __slots__ = ('_values',)
+
+    def __init__(self, points=()):
+        self._values = array('d', [value for point in points for value in point])
+
+    def __len__(self):
+        return len(self._values) // 2
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("point index out of range")
+        return (self._values[2 * index], self._values[2 * index + 1])
+
+    def __iter__(self):
+        values = self._values
+        return ((values[i], values[i + 1]) for i in range(0, len(values), 2))
+
 class MeasurementItem:
-    def __init__(self, type_name, value, unit, description=""):
+    def __init__(self, type_name, value, unit, description="", points=None, page=0,
+                 calibration=None, labelled=True):
         self.type = type_name
-        self.value = value
         self.unit = unit
         self.description = description
+        self.labelled = labelled  # False when the description was generated, not typed
+        self.points = PointArray(points or [])  # (x, y) vertices in page coordinates
+        self.rings = None  # Every ring of an area with holes or several parts
+        self.page = page
+        self.calibration = calibration
+        self.tree_item = None
+        self.raw_quantity = self.calculate_raw_quantity(value)
+        self._value = value
+        self._version = None
+
+    @property
+    def scale_power(self):
+        return SCALE_POWERS.get(self.type, 0) if self.points else 0
+
+    def calculate_raw_quantity(self, value):
+        """Quantity in page units derived from geometry; non-geometric types keep their value"""
+        if self.type == 'Distance' and len(self.points) >= 2:
+            return polyline_length(self.points)
+        if self.type == 'Area' and self.rings:
+            return shape_area(self.rings)
+        if self.type == 'Area' and len(self.points) >= 3:
+            return polygon_area(self.points)
+        return value
+
+    def geometry_rings(self):
+        return self.rings or [self.points]
+
+    def set_rings(self, rings):
+        """Replace area geometry; points keep the largest ring for labels and hit tests"""
+        self.rings = rings if len(rings) > 1 else None
+        self.points = PointArray(max(rings, key=polygon_area))
+        self.raw_quantity = self.calculate_raw_quantity(self._value)
+        self._version = None
+
+    def bounds(self):
+        """Page-space bounding box (x0, y0, x1, y1) of the geometry, or None"""
+        if not self.points:
+            return None
+        boxes = [ring_bounds(ring) for ring in self.geometry_rings()]
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    @property
+    def value(self):
+        """Real-world quantity, recomputed only when the calibration version changes"""
+        if self.calibration is not None and self._version != self.calibration.version:
+            self._value = self.calibration.to_real(self.raw_quantity, self.scale_power)
+            self._version = self.calibration.version
+        return self._value
 
     def __str__(self):
         return f"{self.type}: {self.value:.2f} {self.unit} - {self.description}"
 
+class QuantityTotals:
+    """Running raw quantity sums per layer, page and description, updated in O(1)"""
+    def __init__(self):
+        self._totals = {}  # (scope, key, type) -> [raw sum, count, power, unit]
+
+    def _keys(self, layer_name, measurement):
+        keys = (('layer', layer_name, measurement.type),
+                ('page', measurement.page, measurement.type))
+        if measurement.labelled:
+            keys += (('description', measurement.description, measurement.type),)
+        return keys
+
+    def add(self, layer_name, measurement):
+        """Count a measurement in its groups and return the group keys it touched"""
+        keys = self._keys(layer_name, measurement)
+        for key in keys:
+            entry = self._totals.setdefault(
+                key, [0.0, 0, measurement.scale_power, measurement.unit])
+            entry[0] += measurement.raw_quantity
+            entry[1] += 1
+        return keys
+
+    def remove(self, layer_name, measurement):
+        """Drop a measurement from its groups and return the group keys it touched"""
+        keys = self._keys(layer_name, measurement)
+        for key in keys:
+            entry = self._totals.get(key)
+            if entry is None:
+                continue
+            entry[0] -= measurement.raw_quantity
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._totals[key]
+        return keys
+
+    def summary(self, key, calibration):
+        """(total, count, unit) for one (scope, key, type) group, or None once it is empty"""
+        entry = self._totals.get(key)
+        if entry is None:
+            return None
+        raw, count, power, unit = entry
+        return calibration.to_real(raw, power), count, unit
+
 class DrawingLayer:
     def __init__(self, name, color=QColor('blue')):
         self.name = name
         self.color = color
         self.visible = True
         self.measurements = []
+        self.version = 0  # Bumped on every add or remove so overlay caches can invalidate
+
+class CountOverlay:
+    """Draws count markers as batched sprite blits, merging markers that overlap on screen
+
+    Markers are bucketed into sprite-sized screen cells, so at low zoom dense
+    counts collapse into labelled clusters and repaint cost follows the
+    number of visible cells rather than the number of points.
+    """
+    SPRITE_SIZE = 12
 
-class QuantityEstimator(QMainWindow):
     def __init__(self):
+        self._sprites = {}
+        self._cache = {}  # (layer name, page) -> (version, view key, fragments, labels)
+
+    def sprite(self, color):
+        """Pre-rendered marker for a layer colour"""
+        key = color.rgba()
+        if key not in self._sprites:
+            size = self.SPRITE_SIZE
+            pixmap = QPixmap(size, size)
+            pixmap.fill(Qt.transparent)
+            painter = QPainter(pixmap)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setPen(QPen(color.darker(150), 1.5))
+            painter.setBrush(color)
+            painter.drawEllipse(QRectF(1.5, 1.5, size - 3, size - 3))
+            painter.end()
+            self._sprites[key] = pixmap
+        return self._sprites[key]
+
+    def clusters(self, counts, matrix, origin):
+        """Screen centres and summed counts of markers sharing a sprite-sized cell"""
+        points = np.array([m.points[0] for m in counts], dtype=np.float64)
+        weights = np.array([m.value for m in counts], dtype=np.float64)
+        screen = points @ np.array([[matrix.a, matrix.b], [matrix.c, matrix.d]])
+        screen += (matrix.e - origin[0], matrix.f - origin[1])
+        
+        cells = np.floor(screen / self.SPRITE_SIZE).astype(np.int64)
+        _, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        members = np.bincount(inverse)
+        centres = np.column_stack([np.bincount(inverse, screen[:, 0]) / members,
+                                   np.bincount(inverse, screen[:, 1]) / members])
+        return centres, np.bincount(inverse, weights)
+
+    def draw(self, painter, layer, page, matrix, origin):
+        view_key = (tuple(matrix), origin)
+        cached = self._cache.get((layer.name, page))
+        if cached is None or cached[0] != layer.version or cached[1] != view_key:
+            counts = [m for m in layer.measurements
+                      if m.type == 'Count' and m.page == page and m.points]
+            fragments, labels = [], []
+            if counts:
+                source = QRectF(0, 0, self.SPRITE_SIZE, self.SPRITE_SIZE)
+                centres, totals = self.clusters(counts, matrix, origin)
+                for (x, y), total in zip(centres, totals):
+                    fragments.append(QPainter.PixmapFragment.create(QPointF(x, y), source))
+                    if total > 1:
+                        labels.append((QPointF(x + self.SPRITE_SIZE / 2, y - self.SPRITE_SIZE / 2),
+                                       f"{total:g}"))
+            cached = self._cache[(layer.name, page)] = (layer.version, view_key, fragments, labels)
+        
+        _, _, fragments, labels = cached
+        if fragments:
+            painter.drawPixmapFragments(fragments, self.sprite(layer.color))
+        for pos, text in labels:
+            painter.drawText(pos, text)
+
+def pack_ring(ring):
+    """Ring as a flat array of doubles, rotated to start at its smallest vertex"""
+    ring = list(ring)
+    start = ring.index(min(ring))
+    return array('d', [value for point in ring[start:] + ring[:start] for value in point])
+
+def unpack_ring(packed):
+    return [(packed[i], packed[i + 1]) for i in range(0, len(packed), 2)]
+
+class AddMeasurementCommand:
+    __slots__ = ('measurement',)
+
+    def __init__(self, measurement):
+        self.measurement = measurement
+
+    def undo(self, app):
+        app.remove_measurement(self.measurement)
+
+    def redo(self, app):
+        app.attach_measurement(self.measurement)
+
+class RemoveMeasurementCommand:
+    __slots__ = ('measurement', 'index', 'layer_index')
+
+    def __init__(self, measurement, index, layer_index):
+        self.measurement = measurement
+        self.index = index
+        self.layer_index = layer_index
+
+    def undo(self, app):
+        app.attach_measurement(self.measurement, self.index, self.layer_index)
+
+    def redo(self, app):
+        app.remove_measurement(self.measurement)
+
+class GeometryCommand:
+    """Area edit stored as the rings it removed and added; rings left untouched are not kept"""
+    __slots__ = ('measurement', 'removed', 'added')
+
+    def __init__(self, measurement, old_rings, new_rings):
+        old = {tuple(pack_ring(ring)) for ring in old_rings}
+        new = {tuple(pack_ring(ring)) for ring in new_rings}
+        self.measurement = measurement
+        self.removed = [array('d', ring) for ring in old - new]
+        self.added = [array('d', ring) for ring in new - old]
+
+    def _apply(self, app, drop, restore):
+        current = {tuple(pack_ring(ring)) for ring in self.measurement.geometry_rings()}
+        current -= {tuple(ring) for ring in drop}
+        current |= {tuple(ring) for ring in restore}
+        app.update_area_geometry(self.measurement, [unpack_ring(ring) for ring in current])
+
+    def undo(self, app):
+        self._apply(app, self.added, self.removed)
+
+    def redo(self, app):
+        self._apply(app, self.removed, self.added)
+
+class CalibrationCommand:
+    """Calibration change; also swaps the scale box value shown before and after it"""
+    __slots__ = ('old', 'new', 'shown')
+
+    def __init__(self, old, new, shown):
+        self.old = old
+        self.new = new
+        self.shown = shown
+
+    def _apply(self, app, units_per_foot):
+        self.shown = app.set_calibration(units_per_foot, self.shown)
+
+    def undo(self, app):
+        self._apply(app, self.old)
+
+    def redo(self, app):
+        self._apply(app, self.new)
+
+class LayerCommand:
+    """Change of one layer attribute such as its colour or visibility"""
+    __slots__ = ('layer_name', 'attribute', 'old', 'new')
+
+    def __init__(self, layer_name, attribute, old, new):
+        self.layer_name = layer_name
+        self.attribute = attribute
+        self.old = old
+        self.new = new
+
+    def undo(self, app):
+        app.set_layer_attribute(self.layer_name, self.attribute, self.old)
+
+    def redo(self, app):
+        app.set_layer_attribute(self.layer_name, self.attribute, self.new)
+
+class CompoundCommand:
+    __slots__ = ('commands',)
+
+    def __init__(self, commands):
+        self.commands = commands
+
+    def undo(self, app):
+        for command in reversed(self.commands):
+            command.undo(app)
+
+    def redo(self, app):
+        for command in self.commands:
+            command.redo(app)
+
+class CommandHistory:
+    """Bounded undo/redo log; recording is suspended while commands are replayed"""
+    def __init__(self, limit=1000):
+        self.undo_stack = deque(maxlen=limit)
+        self.redo_stack = []
+        self.replaying = False
+        self._group = None
+
+    def record(self, command):
+        if self.replaying:
+            return
+        if self._group is not None:
+            self._group.append(command)
+            return
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+
+    @contextmanager
+    def group(self):
+        """Record every command issued inside the block as one undo step"""
+        if self._group is not None or self.replaying:
+            yield
+            return
+        self._group = []
+        try:
+            yield
+        finally:
+            commands, self._group = self._group, None
+            if commands:
+                self.record(commands[0] if len(commands) == 1 else CompoundCommand(commands))
+
+    def _replay(self, source, target, app, action):
+        if not source:
+            return False
+        command = source.pop()
+        self.replaying = True
+        try:
+            getattr(command, action)(app)
+        finally:
+            self.replaying = False
+        target.append(command)
+        return True
+
+    def undo(self, app):
+        return self._replay(self.undo_stack, self.redo_stack, app, 'undo')
+
+    def redo(self, app):
+        return self._replay(self.redo_stack, self.undo_stack, app, 'redo')
+
+class RenderCache:
+    """Thread-safe LRU cache of rendered results, capped by total sample bytes"""
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.size -= evicted_bytes
+
+class MappedTile:
+    """A cached tile memory-mapped from disk; rows() reads the mapping without copying it"""
+    HEADER = struct.Struct('<4i')  # width, height, stride, mode index
+    MODES = ('rgb', 'gray', 'mono')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.width, self.height, self.stride, mode_index = self.HEADER.unpack_from(self._mmap)
+        self.mode = self.MODES[mode_index]
+        self._view = memoryview(self._mmap)[self.HEADER.size:]
+
+    def rows(self):
+        """2-D uint8 array over the mapped samples; only valid until close()"""
+        return np.frombuffer(self._view, dtype=np.uint8).reshape(self.height, self.stride)
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+class TileCache:
+    """Persistent raw tile cache shared between app instances and processes
+
+    Tiles are keyed by (file hash, page, zoom bucket, rotation, render mode,
+    tile x/y) and stored in their render mode's format. They are
+    written atomically, so concurrent writers never expose partial files.
+    Least recently used tiles are deleted once the cache exceeds max_bytes.
+    Pages are tiled and written on one background thread via store_page.
+    Reading maps each tile and copies it once into a contiguous page image
+    when the page view changes.
+    """
+    def __init__(self, directory=None, max_bytes=2 * 1024 * 1024 * 1024):
+        self.directory = directory or os.path.join(CACHE_DIR, 'tiles')
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._hashes = {}
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._writing = set()  # Page keys queued or being written
+        self.size = sum(entry.stat().st_size for entry in self._tile_entries())
+
+    def _tile_entries(self):
+        for folder in os.scandir(self.directory):
+            if folder.is_dir():
+                yield from (entry for entry in os.scandir(folder.path) if entry.name.endswith('.tile'))
+
+    def file_hash(self, path):
+        """Hash of size plus the first and last MiB, remembered per path, size and mtime"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            digest = hashlib.sha1(str(stat.st_size).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read(1 << 20))
+                if stat.st_size > 1 << 20:
+                    f.seek(max(1 << 20, stat.st_size - (1 << 20)))
+                    digest.update(f.read())
+            self._hashes[key] = digest.hexdigest()
+        return self._hashes[key]
+
+    def page_key(self, path, page, zoom, rotation, mode='rgb'):
+        """Key prefix for all tiles of one page view; zoom is bucketed to 1/1000"""
+        return (self.file_hash(path), page, int(round(zoom * 1000)), rotation % 360, mode)
+
+    def tile_path(self, page_key, tx, ty):
+        file_hash, page, zoom_bucket, rotation, mode = page_key
+        return os.path.join(self.directory, file_hash,
+                            f"{page}_{zoom_bucket}_{rotation}_{mode}_{tx}_{ty}.tile")
+
+    def get(self, page_key, tx, ty):
+        """Map a cached tile, or return None if it is not cached"""
+        path = self.tile_path(page_key, tx, ty)
+        try:
+            tile = MappedTile(path)
+            os.utime(path)  # Mark as recently used for eviction
+            return tile
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def get_page(self, page_key, width, height):
+        """All tiles of a width x height page as [(x, y, tile)], or None if any is missing"""
+        tiles = []
+        for ty in range(0, height, TILE_SIZE):
+            for tx in range(0, width, TILE_SIZE):
+                tile = self.get(page_key, tx // TILE_SIZE, ty // TILE_SIZE)
+                if tile is None:
+                    for _, _, mapped in tiles:
+                        mapped.close()
+                    return None
+                tiles.append((tx, ty, tile))
+        return tiles
+
+    def put(self, page_key, tx, ty, samples, width, height, stride):
+        path = self.tile_path(page_key, tx, ty)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(MappedTile.HEADER.pack(width, height, stride, MappedTile.MODES.index(page_key[4])))
+            f.write(samples)
+        os.replace(temp_path, path)
+        self.size += MappedTile.HEADER.size + len(samples)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def put_page(self, page_key, rendered):
+        """Slice a full page render into tiles and store them"""
+        rows = np.frombuffer(rendered.samples, dtype=np.uint8).reshape(rendered.height, rendered.stride)
+        for ty in range(0, rendered.height, TILE_SIZE):
+            for tx in range(0, rendered.width, TILE_SIZE):
+                width = min(TILE_SIZE, rendered.width - tx)
+                height = min(TILE_SIZE, rendered.height - ty)
+                # TILE_SIZE is a multiple of 8, so 1-bit tiles start on byte boundaries
+                start = row_bytes(tx, rendered.mode)
+                stride = row_bytes(width, rendered.mode)
+                tile = rows[ty:ty + height, start:start + stride]
+                self.put(page_key, tx // TILE_SIZE, ty // TILE_SIZE, tile.tobytes(), width, height, stride)
+
+    def store_page(self, page_key, rendered):
+        """Queue a page render to be tiled and written off the calling thread"""
+        if page_key in self._writing:
+            return
+        self._writing.add(page_key)
+        self._writer.submit(self._store_page, page_key, rendered)
+
+    def _store_page(self, page_key, rendered):
+        try:
+            self.put_page(page_key, rendered)
+        except OSError as e:
+            print(f"Error writing tile cache: {str(e)}")
+        finally:
+            self._writing.discard(page_key)
+
+    def close(self):
+        """Finish queued writes"""
+        self._writer.shutdown(wait=True)
+
+    def evict(self):
+        """Delete least recently used tiles until the cache is 10% under its cap"""
+        entries = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                          for entry in self._tile_entries()))
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+class RenderService:
+    """Shared render and text index backend behind the local HTTP service"""
+    def __init__(self, workers=None, cache_bytes=512 * 1024 * 1024):
+        self.pool = create_worker_pool(workers)
+        self.cache = RenderCache(cache_bytes)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key, task, *args):
+        """Return a cached result, joining an identical in-flight request if there is one"""
+        hit = self.cache.get(key)
+        if hit is not None:
+            return hit[0]
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = self.pool.submit(task, *args)
+        try:
+            result = future.result()
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        # Text indexes are sized by a rough per-word estimate
+        nbytes = len(result.samples) if isinstance(result, RenderedPage) else 64 * len(result)
+        self.cache.put(key, result, nbytes)
+        return result
+
+    def render(self, path, page, zoom, rotation, tile=None, mode='rgb'):
+        document = file_key(path)
+        key = ('render', document, page, round(zoom, 4), rotation, tile, mode)
+        return self._cached(key, render_page_task, document, page, zoom, rotation, tile, mode)
+
+    def text_index(self, path, page):
+        document = file_key(path)
+        return self._cached(('text', document, page), text_index_task, document, page)
+
+    def call(self, method, params):
+        """Dispatch a JSON-RPC method"""
+        if method == 'page_count':
+            with fitz.open(params['path']) as doc:
+                return len(doc)
+        if method == 'text_index':
+            return self.text_index(params['path'], params['page'])
+        raise ValueError(f"Unknown method: {method}")
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+class RenderServiceHandler(BaseHTTPRequestHandler):
+    """GET /render returns raw samples with geometry headers; POST /rpc takes JSON-RPC 2.0
+
+    Every request must carry the session token in X-Service-Token and name
+    the service's own localhost address in Host. Browser pages cannot set the
+    header cross-origin, and rebound DNS names fail the Host check.
+    """
+    service = None
+    token = None
+    allowed_hosts = ()
+
+    def authorized(self):
+        if self.headers.get('Host') not in self.allowed_hosts:
+            return False
+        return hmac.compare_digest(self.headers.get('X-Service-Token', ''), self.token or '')
+
+    def do_GET(self):
+        if not self.authorized():
+            self.send_error(403)
+            return
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/render':
+            self.send_error(404)
+            return
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            tile = tuple(int(v) for v in query['tile'][0].split(',')) if 'tile' in query else None
+            rendered = self.service.render(query['path'][0], int(query['page'][0]),
+                                           float(query.get('zoom', ['1'])[0]),
+                                           int(query.get('rotation', ['0'])[0]), tile,
+                                           query.get('mode', ['rgb'])[0])
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(rendered.samples)))
+        self.send_header('X-Width', str(rendered.width))
+        self.send_header('X-Height', str(rendered.height))
+        self.send_header('X-Stride', str(rendered.stride))
+        self.send_header('X-Alpha', str(int(rendered.alpha)))
+        self.send_header('X-Origin', f"{rendered.origin[0]},{rendered.origin[1]}")
+        self.send_header('X-Mode', rendered.mode)
+        self.end_headers()
+        self.wfile.write(rendered.samples)
+
+    def do_POST(self):
+        if not self.authorized():
+            self.send_error(403)
+            return
+        if self.path != '/rpc':
+            self.send_error(404)
+            return
+        request = {}
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            response = {'jsonrpc': '2.0', 'id': request.get('id'),
+                        'result': self.service.call(request['method'], request.get('params', {}))}
+        except Exception as e:
+            response = {'jsonrpc': '2.0', 'id': request.get('id'),
+                        'error': {'code': -32000, 'message': str(e)}}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class RenderServiceClient:
+    """Fetches page renders from a running render service
+
+    The session token is read from the file the service writes for its port
+    unless one is given.
+    """
+    def __init__(self, url, token=None, timeout=30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        if token is None:
+            try:
+                with open(service_token_path(urllib.parse.urlparse(self.url).port or 80)) as f:
+                    token = f.read().strip()
+            except OSError as e:
+                print(f"Render service token unavailable: {str(e)}")
+        self.headers = {'X-Service-Token': token or ''}
+
+    def render(self, path, page, zoom, rotation, mode='rgb'):
+        query = {'path': os.path.abspath(path), 'page': page, 'zoom': zoom, 'rotation': rotation,
+                 'mode': mode}
+        request = urllib.request.Request(f"{self.url}/render?{urllib.parse.urlencode(query)}",
+                                         headers=self.headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            headers = response.headers
+            origin = tuple(int(v) for v in headers['X-Origin'].split(','))
+            return RenderedPage(response.read(), int(headers['X-Width']), int(headers['X-Height']),
+                                int(headers['X-Stride']), headers['X-Alpha'] == '1', origin,
+                                headers['X-Mode'])
+
+def service_token_path(port):
+    return os.path.join(CACHE_DIR, f"service-{port}.token")
+
+def serve(host='127.0.0.1', port=8765, workers=None):
+    """Run the local render service until interrupted
+
+    A fresh token is written to a file only the current user can read;
+    clients on this machine pick it up from there.
+    """
+    token_path = service_token_path(port)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if os.path.exists(token_path):
+        os.remove(token_path)
+    RenderServiceHandler.token = secrets.token_urlsafe(32)
+    fd = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(RenderServiceHandler.token)
+    RenderServiceHandler.allowed_hosts = {f"{name}:{port}" for name in (host, 'localhost', '127.0.0.1')}
+    RenderServiceHandler.service = RenderService(workers)
+    server = ThreadingHTTPServer((host, port), RenderServiceHandler)
+    print(f"Render service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        RenderServiceHandler.service.shutdown()
+        os.remove(token_path)
+
+class QuantityEstimator(QMainWindow):
+    def __init__(self, render_service=None, tile_directory=None):
         super().__init__()
+        self.render_service = render_service
         self.layers = {
             'Calibration': DrawingLayer('Calibration', QColor(0, 150, 0)),  # Green
             'Distance': DrawingLayer('Distance', QColor(0, 0, 255)),  # Blue
-            'Area': DrawingLayer('Area', QColor(255, 0, 0))  # Red
+            'Area': DrawingLayer('Area', QColor(255, 0, 0)),  # Red
+            'Count': DrawingLayer('Count', QColor(255, 140, 0))  # Orange
         }
+        self.count_overlay = CountOverlay()
         self.active_layer = 'Distance'  # Default active layer
         
         self.current_pdf = None
         self.current_page = 0
         self.scale_factor = 1.0
+        self.page_matrix = fitz.Matrix(1, 1)
+        self.page_origin = (0, 0)
+        self.calibration = Calibration()
+        self.totals = QuantityTotals()
+        self.total_items = {}  # (scope, key, type) -> row in the totals tree
+        self.shown_calibration_version = None
+        self.history = CommandHistory()
+        self.recorder = None
+        self.revision_changes = {}  # page index -> {'added': [...], 'removed': [...]}
         self.scale_calibration = 1.0
         self.measurement_mode = None
         self.measurement_points = []
@@ -121,10 +1252,22 @@ class QuantityEstimator(QMainWindow):
         self.magnifier = None
         self.orientation = 0
         self.known_scale = None
-        self.current_pixmap = None
+        self.current_image = None  # Page view in its render mode's format; overlays are painted on top
+        self.page_view = None  # (view key, render, image) of the last rendered page view
+        self.render_mode = 'rgb'
+        self.detected_modes = {}
+        try:
+            self.tile_cache = TileCache(tile_directory)
+        except OSError as e:
+            print(f"Tile cache unavailable: {str(e)}")
+            self.tile_cache = None
         self.calibration_in_progress = False
         self.show_magnifier = True  # Always show magnifier
         self.last_mouse_pos = None
+        self.press_modifiers = Qt.NoModifier
+        self.run_length = 0.0  # Page-space length of the polyline being drawn
+        self.run_polygon = QPolygonF()  # Its vertices on screen, kept in step for drawing
+        self.run_view = None  # Page view the on-screen run was built for
         
         self.initUI()
         self.setWindowTitle('Quantity Estimator')
@@ -132,19 +1275,73 @@ class QuantityEstimator(QMainWindow):
         self.setMouseTracking(True)
         self.centralWidget().setMouseTracking(True)
 
+    @property
+    def scale_calibration(self):
+        """Screen pixels per foot at the current zoom level"""
+        return self.calibration.units_per_foot * self.scale_factor
+
+    @scale_calibration.setter
+    def scale_calibration(self, value):
+        old = self.calibration.units_per_foot
+        self.calibration.units_per_foot = value / self.scale_factor
+        if self.calibration.units_per_foot != old:
+            shown = self.scale_value.value() if hasattr(self, 'scale_value') else None
+            self.history.record(CalibrationCommand(old, self.calibration.units_per_foot, shown))
+            self.record_interaction('calibration', units_per_foot=self.calibration.units_per_foot)
+
+    def pixmap_pos(self, pos):
+        """Map a position on the page label onto its pixmap, which sits inside the centring margins"""
+        if self.current_image is None:
+            return QPointF(pos)
+        return QPointF(pos) - QPointF(self.page_offset())
+
+    def page_offset(self):
+        """Top left of the page image inside the label, placed as QLabel places a pixmap"""
+        return QStyle.alignedRect(self.pdf_label.layoutDirection(), self.pdf_label.alignment(),
+                                  self.current_image.size(), self.pdf_label.contentsRect()).topLeft()
+
+    def set_calibration(self, units_per_foot, shown):
+        """Restore a calibration and the scale box value shown with it; returns the value replaced"""
+        self.calibration.units_per_foot = units_per_foot
+        replaced = self.scale_value.value()
+        if shown is not None:
+            self.scale_value.blockSignals(True)
+            self.scale_value.setValue(shown)
+            self.scale_value.blockSignals(False)
+        return replaced
+
+    def to_page_point(self, pos):
+        """Map a position on the rendered page to page coordinates, undoing zoom and view rotation"""
+        point = fitz.Point(pos.x() + self.page_origin[0],
+                           pos.y() + self.page_origin[1]) * ~self.page_matrix
+        return (point.x, point.y)
+
+    def from_page_point(self, point):
+        """Map page coordinates back onto the rendered page"""
+        pos = fitz.Point(point[0], point[1]) * self.page_matrix
+        return QPointF(pos.x - self.page_origin[0], pos.y - self.page_origin[1])
+
+    def layer_for(self, measurement_type):
+        return measurement_type if measurement_type in self.layers else 'Distance'
+
     def mouseMoveEvent(self, event):
-        if self.current_pixmap and self.magnifier:
+        if self.current_image is not None and self.magnifier:
             pdf_pos = self.pdf_label.mapFromGlobal(event.globalPos())
             if self.pdf_label.rect().contains(pdf_pos):
-                self.magnifier.update_magnifier(pdf_pos, self.current_pixmap, True)
+                self.magnifier.update_magnifier(self.pixmap_pos(pdf_pos), self.current_image, True)
             else:
                 self.magnifier.hide()
         super().mouseMoveEvent(event)
 
     def closeEvent(self, event):
         try:
+            if self.recorder:
+                self.recorder.close()
+                self.recorder = None
             if self.magnifier:
                 self.magnifier.cleanup()
+            if self.tile_cache:
+                self.tile_cache.close()
             if self.current_pdf:
                 self.current_pdf.close()
             event.accept()
@@ -154,55 +1351,280 @@ class QuantityEstimator(QMainWindow):
 
     def change_page(self, value):
         if self.current_pdf:
+            self.record_interaction('page', page=value - 1)
             self.current_page = value - 1
             self.display_page()
 
-    def add_measurement_to_list(self, measurement_type, value, unit, description=None):
-        """Add a measurement to the tree widget and layer"""
+    def add_measurement_to_list(self, measurement_type, value, unit, description=None, labelled=None):
+        """Add a measurement to the tree widget and layer
+
+        Only typed descriptions are totalled by description; generated labels
+        such as "Point 12" are unique and just name the row.
+        """
         try:
+            if labelled is None:
+                labelled = bool(description)
             if not description:
-                description = f"{measurement_type} {len(self.measurements) + 1}"
-            
-            measurement = MeasurementItem(measurement_type, value, unit, description)
-            measurement.points = self.measurement_points.copy()
+                name = "Point" if measurement_type == "Count" else measurement_type
+                description = f"{name} {len(self.measurements) + 1}"
             
-            layer_name = measurement_type if measurement_type in self.layers else 'Distance'
-            self.layers[layer_name].measurements.append(measurement)
-            self.measurements.append(measurement)
+            measurement = MeasurementItem(measurement_type, value, unit, description,
+                                          self.measurement_points, self.current_page, self.calibration,
+                                          labelled)
+            self.attach_measurement(measurement)
+            self.history.record(AddMeasurementCommand(measurement))
             
-            item = QTreeWidgetItem(self.measurements_tree)
-            item.setText(0, measurement_type)
-            item.setText(1, f"{value:.2f} {unit}")
-            item.setText(2, description)
+            self.description_input.clear()
+            return measurement
             
-            layer_color = self.layers[layer_name].color
-            for col in range(3):
-                item.setBackground(col, QColor(layer_color.red(), layer_color.green(), layer_color.blue(), 30))
+        except Exception as e:
+            print(f"Error adding measurement to list: {str(e)}")
+
+    def attach_measurement(self, measurement, index=None, layer_index=None):
+        """Insert a measurement into its layer, the totals and the tree widget"""
+        layer_name = self.layer_for(measurement.type)
+        layer = self.layers[layer_name]
+        if index is None:
+            index = len(self.measurements)
+        if layer_index is None:
+            layer_index = len(layer.measurements)
+        layer.measurements.insert(layer_index, measurement)
+        layer.version += 1
+        self.measurements.insert(index, measurement)
+        keys = self.totals.add(layer_name, measurement)
+        
+        item = QTreeWidgetItem()
+        item.setText(0, measurement.type)
+        item.setText(1, f"{measurement.value:.2f} {measurement.unit}")
+        item.setText(2, measurement.description)
+        self.measurements_tree.insertTopLevelItem(index, item)
+        measurement.tree_item = item
+        
+        for col in range(3):
+            item.setBackground(col, QColor(layer.color.red(), layer.color.green(), layer.color.blue(), 30))
+        
+        self.fit_columns(self.measurements_tree, item)
+        self.refresh_totals(keys)
+
+    def fit_columns(self, tree, item):
+        """Widen columns only for a new row; resizing to all contents is O(n) per add"""
+        metrics = tree.fontMetrics()
+        for col in range(tree.columnCount()):
+            width = metrics.horizontalAdvance(item.text(col)) + 2 * metrics.averageCharWidth()
+            if width > tree.columnWidth(col):
+                tree.setColumnWidth(col, width)
+
+    def remove_measurement(self, measurement):
+        """Remove a measurement from its layer, the totals and the tree widget"""
+        try:
+            layer_name = self.layer_for(measurement.type)
+            self.history.record(RemoveMeasurementCommand(
+                measurement, self.measurements.index(measurement),
+                self.layers[layer_name].measurements.index(measurement)))
+            self.layers[layer_name].measurements.remove(measurement)
+            self.layers[layer_name].version += 1
+            self.measurements.remove(measurement)
+            keys = self.totals.remove(layer_name, measurement)
             
-            self.measurements_tree.resizeColumnToContents(0)
-            self.measurements_tree.resizeColumnToContents(1)
-            self.measurements_tree.resizeColumnToContents(2)
+            if measurement.tree_item is not None:
+                index = self.measurements_tree.indexOfTopLevelItem(measurement.tree_item)
+                if index >= 0:
+                    self.measurements_tree.takeTopLevelItem(index)
+                measurement.tree_item = None
             
-            self.description_input.clear()
+            self.refresh_totals(keys)
             
         except Exception as e:
-            print(f"Error adding measurement to list: {str(e)}")
+            print(f"Error removing measurement: {str(e)}")
+
+    def refresh_totals(self, keys=None):
+        """Update the totals rows of the given groups, or every row after a calibration change"""
+        for key in list(self.total_items) if keys is None else keys:
+            summary = self.totals.summary(key, self.calibration)
+            item = self.total_items.get(key)
+            if summary is None:
+                if item is not None:
+                    self.totals_tree.invisibleRootItem().removeChild(item)
+                    del self.total_items[key]
+                continue
+            total, count, unit = summary
+            if item is None:
+                scope, group, type_name = key
+                label = f"Page {group + 1}" if scope == 'page' else str(group)
+                item = QTreeWidgetItem(self.totals_tree)
+                item.setText(0, f"{scope.title()}: {label}")
+                item.setText(1, type_name)
+                self.total_items[key] = item
+            item.setText(2, f"{total:.2f} {unit} ({count})")
+            self.fit_columns(self.totals_tree, item)
+
+    def refresh_quantities(self):
+        """Refresh displayed values once after each calibration change"""
+        if self.shown_calibration_version == self.calibration.version:
+            return
+        self.shown_calibration_version = self.calibration.version
+        for measurement in self.measurements:
+            if measurement.tree_item is not None and measurement.scale_power:
+                measurement.tree_item.setText(1, f"{measurement.value:.2f} {measurement.unit}")
+        self.refresh_totals()
 
     def load_pdf(self):
         file_name, _ = QFileDialog.getOpenFileName(self, "Open PDF File", "", "PDF Files (*.pdf)")
         if file_name:
             try:
-                self.current_pdf = fitz.open(file_name)
-                self.current_page = 0
-                self.page_spin.setMaximum(len(self.current_pdf))
-                self.page_spin.setValue(1)
-                self.display_page()
+                self.open_pdf(file_name)
             except Exception as e:
                 print(f"Error loading PDF: {str(e)}")
                 QMessageBox.warning(self, "Error", "Failed to load PDF")
 
+    def open_pdf(self, file_name):
+        self.record_interaction('open', path=os.path.abspath(file_name))
+        self.current_pdf = fitz.open(file_name)
+        self.current_page = 0
+        self.page_view = None
+        self.revision_changes = {}
+        self.detected_modes = {}
+        self.page_spin.setMaximum(len(self.current_pdf))
+        self.page_spin.setValue(1)
+        self.display_page()
+
+    def start_recording(self, path):
+        """Record interactions to a trace file for later replay with --replay
+
+        Call once the window is shown so the recorded size is the real one;
+        later resizes are recorded as they happen, since the centring margins
+        and so the page point under each recorded click depend on it.
+        """
+        self.recorder = InteractionRecorder(path)
+        self.record_interaction('start', width=self.width(), height=self.height())
+
+    def resizeEvent(self, event):
+        self.record_interaction('resize', width=event.size().width(), height=event.size().height())
+        super().resizeEvent(event)
+
+    def record_interaction(self, event, **data):
+        if self.recorder:
+            self.recorder.write(event, **data)
+
+    def record_mouse(self, event_name, event):
+        if self.recorder:
+            self.recorder.write(event_name, x=event.pos().x(), y=event.pos().y(),
+                                button=int(event.button()), buttons=int(event.buttons()),
+                                modifiers=int(event.modifiers()))
+
+    def compare_revision(self):
+        """Diff the current PDF against a previous revision and overlay the changes"""
+        if not self.current_pdf:
+            QMessageBox.warning(self, "Warning", "Please load a PDF first")
+            return
+        
+        file_name, _ = QFileDialog.getOpenFileName(self, "Open Previous Revision", "", "PDF Files (*.pdf)")
+        if not file_name:
+            return
+        dpi, ok = QInputDialog.getInt(self, "Compare Revision", "Comparison DPI:", 100, 36, 300)
+        if not ok:
+            return
+        
+        try:
+            progress = QProgressDialog("Comparing pages...", "Cancel", 0, len(self.current_pdf), self)
+            progress.setWindowModality(Qt.WindowModal)
+            started = time.perf_counter()
+            
+            changes = {}
+            deleted = []
+            pages = compare_revisions(file_name, self.current_pdf.name, dpi)
+            for page_index, page_changes in pages:
+                if page_index is None:
+                    deleted.append(page_changes['deleted'] + 1)
+                    continue
+                changes[page_index] = page_changes
+                progress.setValue(len(changes))
+                QApplication.processEvents()
+                if progress.wasCanceled():
+                    pages.close()
+                    break
+            progress.close()
+            
+            self.revision_changes = changes
+            self.show_changes_cb.setEnabled(True)
+            self.show_changes_cb.setChecked(True)
+            self.display_page()
+            
+            changed_pages = sorted(i + 1 for i, c in changes.items() if c['added'] or c['removed'])
+            affected = set(self.measurements_in_changes())
+            for measurement in self.measurements:
+                if measurement.tree_item is not None:
+                    font = measurement.tree_item.font(2)
+                    font.setBold(measurement in affected)
+                    measurement.tree_item.setFont(2, font)
+            
+            QMessageBox.information(self, "Revision Comparison",
+                f"Compared {len(changes)} pages in {time.perf_counter() - started:.1f} s\n"
+                f"Changed pages: {', '.join(map(str, changed_pages)) or 'none'}\n"
+                f"Deleted pages of the previous revision: {', '.join(map(str, sorted(deleted))) or 'none'}\n"
+                f"Measurements in changed regions: {len(affected)}")
+                
+        except Exception as e:
+            print(f"Error comparing revisions: {str(e)}")
+            QMessageBox.warning(self, "Error", "Failed to compare revisions")
+
+    def collect_markups(self):
+        """Plain per-page markup data for every layer, ready to hand to worker processes"""
+        markups = {}
+        for layer in self.layers.values():
+            color = (layer.color.redF(), layer.color.greenF(), layer.color.blueF())
+            for measurement in layer.measurements:
+                if not measurement.points:
+                    continue
+                label = f"{measurement.description}: {measurement.value:.2f} {measurement.unit}"
+                markups.setdefault(measurement.page, []).append(
+                    (measurement.type, [list(ring) for ring in measurement.geometry_rings()], color, label))
+        return markups
+
+    def export_markup(self):
+        """Write all measurements into a copy of the PDF as vector drawings"""
+        if not self.current_pdf:
+            QMessageBox.warning(self, "Warning", "Please load a PDF first")
+            return
+        
+        file_name, _ = QFileDialog.getSaveFileName(self, "Export Marked-up PDF", "", "PDF Files (*.pdf)")
+        if not file_name:
+            return
+        
+        try:
+            progress = QProgressDialog("Exporting markup...", None, 0, len(self.current_pdf), self)
+            progress.setWindowModality(Qt.WindowModal)
+            try:
+                for pages_done in export_markup_pdf(self.current_pdf.name, file_name, self.collect_markups()):
+                    progress.setValue(pages_done)
+                    QApplication.processEvents()
+            finally:
+                progress.close()
+            QMessageBox.information(self, "Export Complete", f"Marked-up PDF saved to {file_name}")
+            
+        except ValueError as e:
+            QMessageBox.warning(self, "Export Markup", str(e))
+        except Exception as e:
+            print(f"Error exporting markup: {str(e)}")
+            QMessageBox.warning(self, "Error", "Failed to export marked-up PDF")
+
+    def measurements_in_changes(self):
+        """Measurements whose geometry overlaps a changed region on their page"""
+        affected = []
+        for measurement in self.measurements:
+            bounds = measurement.bounds()
+            changes = self.revision_changes.get(measurement.page)
+            if bounds is None or not changes:
+                continue
+            mx0, my0, mx1, my1 = bounds
+            if any(mx0 <= x1 and x0 <= mx1 and my0 <= y1 and y0 <= my1
+                   for x0, y0, x1, y1 in changes['added'] + changes['removed']):
+                affected.append(measurement)
+        return affected
+
     def start_calibration(self):
         """Start calibration process with scale handling"""
+        self.record_interaction('calibrate')
         try:
             if not self.current_pdf:
                 QMessageBox.warning(self, "Warning", "Please load a PDF first")
@@ -242,6 +1664,7 @@ class QuantityEstimator(QMainWindow):
         measurement_handlers = {
             'distance': self.handle_distance_measurement,
             'area': self.handle_area_measurement,
+            'polyline': self.handle_polyline_measurement,
             'count': self.handle_count_measurement,
             'calibration': self.handle_calibration_measurement
         }
@@ -260,61 +1683,92 @@ class QuantityEstimator(QMainWindow):
                 
                 if layer_name == 'Calibration' and self.calibration_in_progress:
                     if len(self.measurement_points) >= 2:
-                        painter.drawLine(self.measurement_points[0], self.measurement_points[1])
+                        painter.drawLine(self.from_page_point(self.measurement_points[0]),
+                                         self.from_page_point(self.measurement_points[1]))
                         
                 elif layer_name == 'Distance' and self.measurement_mode == 'distance':
                     if len(self.measurement_points) >= 2:
-                        painter.drawLine(self.measurement_points[0], self.measurement_points[1])
+                        painter.drawLine(self.from_page_point(self.measurement_points[0]),
+                                         self.from_page_point(self.measurement_points[1]))
+                        
+                elif layer_name == 'Distance' and self.measurement_mode == 'polyline':
+                    painter.drawPolyline(self.run_polygon)
+                    if self.drawing and self.current_measurement and self.measurement_points:
+                        painter.drawLine(self.from_page_point(self.measurement_points[-1]),
+                                         self.from_page_point(self.current_measurement))
                         
                 elif layer_name == 'Area' and self.measurement_mode == 'area':
                     self.draw_area_polygon(painter)
+                
+                self.count_overlay.draw(painter, layer, self.current_page,
+                                        self.page_matrix, self.page_origin)
                     
         except Exception as e:
             print(f"Error in draw_measurements: {str(e)}")
             
+    def draw_revision_changes(self, painter):
+        """Overlay regions added (green) and removed (red) since the compared revision"""
+        changes = self.revision_changes.get(self.current_page)
+        if not changes:
+            return
+        
+        painter.setPen(Qt.NoPen)
+        for kind, color in (('added', QColor(0, 200, 0, 70)), ('removed', QColor(255, 0, 0, 70))):
+            painter.setBrush(color)
+            for x0, y0, x1, y1 in changes[kind]:
+                rect = QRectF(self.from_page_point((x0, y0)), self.from_page_point((x1, y1)))
+                painter.drawRect(rect.normalized())
+        painter.setBrush(Qt.NoBrush)
+
     def draw_area_polygon(self, painter):
         """Draw area polygon with optimized point handling"""
         if len(self.measurement_points) < 2:
             return
             
         # Draw existing lines
-        points = self.measurement_points
+        points = [self.from_page_point(p) for p in self.measurement_points]
         for i in range(len(points) - 1):
             painter.drawLine(points[i], points[i + 1])
             
         # Draw current line and closing lines
         if self.drawing and self.current_measurement:
-            painter.drawLine(points[-1], self.current_measurement)
+            current = self.from_page_point(self.current_measurement)
+            painter.drawLine(points[-1], current)
             if len(points) >= 3:
-                painter.drawLine(self.current_measurement, points[0])
+                painter.drawLine(current, points[0])
         elif len(points) >= 3:
             painter.drawLine(points[-1], points[0])
 
     def on_mouse_press(self, event):
+        self.record_mouse('press', event)
+        self.press_modifiers = event.modifiers()
         if event.button() == Qt.LeftButton:
-            self.handle_measurement(event.pos())
+            self.handle_measurement(self.to_page_point(self.pixmap_pos(event.pos())))
 
     def on_mouse_move(self, event):
+        self.record_mouse('move', event)
         try:
-            if not self.pdf_label.pixmap() or self.pdf_label.pixmap().isNull():
+            if self.current_image is None:
                 return
             self.last_mouse_pos = event.pos()
-            if self.show_magnifier and self.magnifier and self.current_pixmap:
+            if self.show_magnifier and self.magnifier and self.current_image is not None:
                 viewport_pos = self.pdf_label.mapFromGlobal(QCursor.pos())
-                self.magnifier.update_magnifier(viewport_pos, self.current_pixmap, force_show=True)
-            if self.drawing and self.measurement_mode == "area":
-                self.current_measurement = event.pos()
+                self.magnifier.update_magnifier(self.pixmap_pos(viewport_pos), self.current_image,
+                                                force_show=True)
+            if self.drawing and self.measurement_mode in ("area", "polyline"):
+                self.current_measurement = self.to_page_point(self.pixmap_pos(event.pos()))
+                if self.measurement_mode == "polyline":
+                    self.update_run_status()
                 self.display_page()
         except Exception as e:
             print(f"Error in mouse move: {str(e)}")
 
     def on_mouse_release(self, event):
+        self.record_mouse('release', event)
         try:
+            # Area vertices are added on press and the polygon is closed with Ctrl-click
             if self.drawing and self.measurement_mode == "area":
-                self.measurement_points.append(event.pos())
                 self.current_measurement = None
-                if len(self.measurement_points) >= 3:
-                    self.calculate_area()
                 self.display_page()
         except Exception as e:
             print(f"Error in mouse release: {str(e)}")
@@ -323,8 +1777,7 @@ class QuantityEstimator(QMainWindow):
         try:
             if len(self.measurement_points) != 2:
                 return
-            pixels = ((self.measurement_points[1].x() - self.measurement_points[0].x()) ** 2 +
-                     (self.measurement_points[1].y() - self.measurement_points[0].y()) ** 2) ** 0.5
+            pixels = self.segment_length(*self.measurement_points) * self.scale_factor
             
             if self.known_scale:
                 self.scale_calibration = pixels / self.known_scale
@@ -359,15 +1812,57 @@ class QuantityEstimator(QMainWindow):
             print(f"Error in cleanup_calibration: {str(e)}")
 
     def keyPressEvent(self, event):
+        self.record_interaction('key', key=event.key(), modifiers=int(event.modifiers()))
         if event.key() == Qt.Key_Escape:
             self.cleanup_calibration()
+        elif event.matches(QKeySequence.Undo):
+            self.undo()
+        elif event.matches(QKeySequence.Redo):
+            self.redo()
+        elif event.key() == Qt.Key_Delete:
+            self.delete_selected_measurements()
+
+    def undo(self):
+        """Drop the last vertex of a polygon in progress, otherwise undo the last command"""
+        if self.drawing and self.measurement_points:
+            self.remove_last_vertex()
+        else:
+            self.history.undo(self)
+        self.display_page()
+
+    def redo(self):
+        self.history.redo(self)
+        self.display_page()
+
+    def delete_selected_measurements(self):
+        selected = {id(item) for item in self.measurements_tree.selectedItems()}
+        with self.history.group():
+            for measurement in [m for m in self.measurements if id(m.tree_item) in selected]:
+                self.remove_measurement(measurement)
+        self.display_page()
+
+    def set_layer_attribute(self, layer_name, attribute, value):
+        """Apply a layer colour or visibility change and sync its controls"""
+        layer = self.layers[layer_name]
+        controls = self.layer_controls[layer_name]
+        if attribute == 'color':
+            layer.color = QColor(value)
+            controls['color_button'].setStyleSheet(f"background-color: {layer.color.name()}; border: none;")
+        else:
+            layer.visible = value
+            controls['checkbox'].blockSignals(True)
+            controls['checkbox'].setChecked(value)
+            controls['checkbox'].blockSignals(False)
+        self.display_page()
 
     def change_measurement_mode(self, mode):
         """Change the current measurement mode and update UI"""
+        self.record_interaction('mode', mode=mode)
         # Reset current measurement state
         self.measurement_points = []
         self.current_measurement = None
         self.drawing = False
+        self.reset_run()
         self.show_magnifier = True  # Always keep magnifier active
         
         # Set measurement mode and active layer
@@ -379,7 +1874,7 @@ class QuantityEstimator(QMainWindow):
             self.active_layer = mode
         
         # Update cursor based on measurement mode
-        if self.measurement_mode in ['distance', 'area', 'count']:
+        if self.measurement_mode in ['distance', 'polyline', 'area', 'count']:
             self.pdf_label.setCursor(Qt.CrossCursor)
         else:
             self.pdf_label.setCursor(Qt.ArrowCursor)
@@ -393,6 +1888,7 @@ class QuantityEstimator(QMainWindow):
             self.orientation = 90
         else:
             self.orientation = -90
+        self.record_interaction('orientation', angle=self.orientation)
         self.display_page()
 
     def parse_architectural_scale(self, scale_text):
@@ -405,6 +1901,8 @@ class QuantityEstimator(QMainWindow):
     def toggle_layer_visibility(self, layer_name, state):
         """Toggle visibility of a measurement layer"""
         if layer_name in self.layers:
+            self.history.record(LayerCommand(layer_name, 'visible',
+                                             self.layers[layer_name].visible, bool(state)))
             self.layers[layer_name].visible = bool(state)
             self.display_page()
 
@@ -413,10 +1911,9 @@ class QuantityEstimator(QMainWindow):
         if layer_name in self.layers:
             color = QColorDialog.getColor(self.layers[layer_name].color)
             if color.isValid():
-                self.layers[layer_name].color = color
-                btn = self.layer_controls[layer_name]['color_button']
-                btn.setStyleSheet(f"background-color: {color.name()}; border: none;")
-                self.display_page()
+                self.history.record(LayerCommand(layer_name, 'color',
+                                                 self.layers[layer_name].color.rgba(), color.rgba()))
+                self.set_layer_attribute(layer_name, 'color', color.rgba())
 
     def handle_distance_measurement(self, pos):
         """Handle distance measurement logic"""
@@ -426,13 +1923,78 @@ class QuantityEstimator(QMainWindow):
             self.measurement_points = []
             self.display_page()
 
+    def handle_polyline_measurement(self, pos):
+        """Add a vertex to the current run; Ctrl-click adds the last vertex and finishes it"""
+        if self.measurement_points:
+            self.run_length += self.segment_length(self.measurement_points[-1], pos)
+        self.measurement_points.append(pos)
+        self.run_polygon.append(self.from_page_point(pos))
+        self.drawing = True
+        if len(self.measurement_points) >= 2 and self.press_modifiers & Qt.ControlModifier:
+            self.calculate_polyline()
+        else:
+            self.update_run_status()
+            self.display_page()
+
+    def segment_length(self, p1, p2):
+        """Length between two page points, in page units"""
+        return math.hypot(p2[0] - p1[0], p2[1] - p1[1])
+
+    def remove_last_vertex(self):
+        """Drop the newest vertex of an area or run in progress"""
+        point = self.measurement_points.pop()
+        if self.measurement_mode == 'polyline':
+            self.run_polygon.remove(self.run_polygon.size() - 1)
+            if len(self.measurement_points) > 1:
+                self.run_length -= self.segment_length(self.measurement_points[-1], point)
+            else:
+                self.run_length = 0.0
+            self.update_run_status()
+        self.drawing = bool(self.measurement_points)
+
+    def update_run_status(self):
+        """Show the live length of the run, including the segment following the cursor"""
+        if not self.measurement_points:
+            self.statusBar().clearMessage()
+            return
+        length = self.run_length
+        if self.current_measurement is not None:
+            length += self.segment_length(self.measurement_points[-1], self.current_measurement)
+        feet = self.calibration.to_real(length, 1)
+        self.statusBar().showMessage(
+            f"Run: {feet:.2f} feet over {len(self.measurement_points) - 1} segments")
+
+    def reset_run(self):
+        self.run_length = 0.0
+        self.run_polygon = QPolygonF()
+        self.statusBar().clearMessage()
+
+    def sync_run_polygon(self):
+        """Rebuild the on-screen run once per page view change; vertices stay in page space"""
+        if self.run_view != self.page_view[0]:
+            self.run_view = self.page_view[0]
+            if self.measurement_mode == 'polyline':
+                self.run_polygon = QPolygonF([self.from_page_point(p) for p in self.measurement_points])
+
+    def calculate_polyline(self):
+        """Record the current run as one distance measurement"""
+        if self.scale_calibration:
+            feet = self.calibration.to_real(self.run_length, 1)
+            description = self.description_input.text()
+            self.add_measurement_to_list("Distance", feet, "feet", description)
+        
+        self.drawing = False
+        self.measurement_points = []
+        self.current_measurement = None
+        self.reset_run()
+        self.display_page()
+
     def handle_area_measurement(self, pos):
         """Handle area measurement logic"""
         self.measurement_points.append(pos)
         self.drawing = True
         if len(self.measurement_points) >= 3:
-            modifiers = QApplication.keyboardModifiers()
-            if modifiers & Qt.ControlModifier:
+            if self.press_modifiers & Qt.ControlModifier:
                 self.calculate_area()
                 self.drawing = False
                 self.measurement_points = []
@@ -440,8 +2002,10 @@ class QuantityEstimator(QMainWindow):
 
     def handle_count_measurement(self, pos):
         """Handle count measurement logic"""
-        description = self.description_input.text() or f"Point {len(self.measurements) + 1}"
+        description = self.description_input.text()
+        self.measurement_points = [pos]
         self.add_measurement_to_list("Count", 1, "point", description)
+        self.measurement_points = []
         self.display_page()
 
     def handle_calibration_measurement(self, pos):
@@ -456,17 +2020,18 @@ class QuantityEstimator(QMainWindow):
     def prompt_for_distance(self):
         """Prompt user for actual distance during calibration"""
         try:
-            p1, p2 = self.measurement_points
-            pixels = ((p2.x() - p1.x()) ** 2 + (p2.y() - p1.y()) ** 2) ** 0.5
+            pixels = self.segment_length(*self.measurement_points) * self.scale_factor
             
             distance, ok = QInputDialog.getDouble(self, "Enter Distance",
                 "Enter the actual distance (in feet):", 1, 0, 1000, 2)
             
             if ok:
-                self.scale_calibration = pixels / distance
-                self.scale_value.setValue(distance)
-                calibration_desc = f"Calibration Line ({distance:.2f} ft)"
-                self.add_measurement_to_list("Calibration", distance, "feet", calibration_desc)
+                with self.history.group():
+                    self.scale_calibration = pixels / distance
+                    self.scale_value.setValue(distance)
+                    calibration_desc = f"Calibration Line ({distance:.2f} ft)"
+                    self.add_measurement_to_list("Calibration", distance, "feet", calibration_desc,
+                                                 labelled=False)
                 QMessageBox.information(self, "Calibration Complete", 
                     f"Scale set to {distance:.2f} feet per {pixels:.2f} pixels")
             else:
@@ -480,37 +2045,75 @@ class QuantityEstimator(QMainWindow):
             self.cleanup_calibration()
 
     def calculate_area(self):
-        """Calculate polygon area with optimized loop"""
+        """Close the current polygon as a new area, or add it to or deduct it from an existing one"""
         if len(self.measurement_points) < 3:
             return
-            
-        points = self.measurement_points
-        n = len(points)
-        area = sum(points[i].x() * points[(i + 1) % n].y() - 
-                  points[(i + 1) % n].x() * points[i].y() 
-                  for i in range(n))
-        area = abs(area) / 2
         
-        if self.scale_calibration:
-            square_feet = area / (self.scale_calibration ** 2)
-            description = self.description_input.text()
-            self.add_measurement_to_list("Area", square_feet, "sq.ft", description)
+        ring = []
+        for point in self.measurement_points:
+            if not ring or point != ring[-1]:
+                ring.append(point)
+        operation = self.area_operation.currentText()
+        
+        if len(ring) < 3 or ring_self_intersects(ring):
+            QMessageBox.warning(self, "Invalid Area", "The area outline crosses itself; please redraw it")
+        elif operation == 'New Area':
+            if self.scale_calibration:
+                square_feet = self.calibration.to_real(polygon_area(ring), 2)
+                description = self.description_input.text()
+                self.add_measurement_to_list("Area", square_feet, "sq.ft", description)
+        else:
+            target = self.target_area(ring)
+            if target is None:
+                QMessageBox.warning(self, "No Area", "Draw over an existing area on this page")
+            else:
+                rings = combine_areas(target.geometry_rings(), [ring],
+                                      'union' if operation == 'Add to Area' else 'difference')
+                self.update_area_geometry(target, rings)
         
         self.drawing = False
         self.measurement_points = []
         self.current_measurement = None
         self.display_page()
         
+    def target_area(self, ring):
+        """Most recent area on the current page that a ring actually overlaps"""
+        x0, y0, x1, y1 = ring_bounds(ring)
+        path = None
+        for measurement in reversed(self.layers['Area'].measurements):
+            if measurement.page != self.current_page:
+                continue
+            # Bounds reject most areas cheaply; the path test handles L shapes and holes
+            bx0, by0, bx1, by1 = measurement.bounds()
+            if not (bx0 <= x1 and x0 <= bx1 and by0 <= y1 and y0 <= by1):
+                continue
+            path = path or rings_to_path([ring])
+            if rings_to_path(measurement.geometry_rings()).intersects(path):
+                return measurement
+        return None
+
+    def update_area_geometry(self, measurement, rings):
+        """Replace an area's rings, keeping totals, tree and overlays in step"""
+        if not rings:
+            self.remove_measurement(measurement)
+            return
+        layer_name = self.layer_for(measurement.type)
+        self.history.record(GeometryCommand(measurement, measurement.geometry_rings(), rings))
+        self.totals.remove(layer_name, measurement)
+        measurement.set_rings(rings)
+        keys = self.totals.add(layer_name, measurement)
+        self.layers[layer_name].version += 1
+        if measurement.tree_item is not None:
+            measurement.tree_item.setText(1, f"{measurement.value:.2f} {measurement.unit}")
+        self.refresh_totals(keys)
+
     def calculate_distance(self):
         """Calculate distance with vector math"""
         if len(self.measurement_points) != 2:
             return
             
-        p1, p2 = self.measurement_points
-        pixels = ((p2.x() - p1.x()) ** 2 + (p2.y() - p1.y()) ** 2) ** 0.5
-        
         if self.scale_calibration:
-            feet = pixels / self.scale_calibration
+            feet = self.calibration.to_real(self.segment_length(*self.measurement_points), 1)
             description = self.description_input.text()
             self.add_measurement_to_list("Distance", feet, "feet", description)
             
@@ -526,59 +2129,129 @@ class QuantityEstimator(QMainWindow):
             # Get the current page
             page = self.current_pdf[self.current_page]
             
-            # Create transformation matrix with scale and rotation
-            matrix = fitz.Matrix(self.scale_factor, self.scale_factor)
-            if self.orientation != 0:
-                matrix.preRotate(self.orientation)
-            
-            # Render the page
-            pix = page.get_pixmap(matrix=matrix)
-            fmt = QImage.Format_RGBA8888 if pix.alpha else QImage.Format_RGB888
-            img = QImage(pix.samples, pix.width, pix.height, pix.stride, fmt)
-            self.current_pixmap = QPixmap.fromImage(img)
-            
-            # Draw measurements
-            painter = QPainter(self.current_pixmap)
-            painter.setRenderHint(QPainter.Antialiasing)
-            self.draw_measurements(painter)
-            painter.end()
-            
-            # Update PDF label
-            self.pdf_label.setPixmap(self.current_pixmap)
+            # Render the page from cached tiles, the render service or locally;
+            # measurements are painted over it when the label repaints
+            self.current_image, self.page_origin = self.page_image(page)
+            self.page_matrix = page_view_matrix(self.scale_factor, self.orientation)
+            self.sync_run_polygon()
+            self.pdf_label.update()
             
             # Center the page in the scroll area
             self.center_page_in_scroll_area()
+            self.refresh_quantities()
             
         except Exception as e:
             print(f"Error in display_page: {str(e)}")
             
+    def page_image(self, page):
+        """Page view as (QImage, origin), loaded once per page, zoom, rotation and render mode
+
+        The image keeps the render mode's format, so grayscale pages take one
+        byte per pixel and 1-bit pages one bit.
+        """
+        view_key = (self.current_page, self.scale_factor, self.orientation, self.page_render_mode(page))
+        if self.page_view is None or self.page_view[0] != view_key:
+            rendered = self.load_page_render(page)
+            self.page_view = (view_key, rendered, rendered_image(rendered))
+        return self.page_view[2], self.page_view[1].origin
+
+    def paint_page(self, event):
+        """Paint the exposed part of the page image, then the overlays on top of it"""
+        if self.current_image is None:
+            QLabel.paintEvent(self.pdf_label, event)
+            return
+        try:
+            painter = QPainter(self.pdf_label)
+            offset = self.page_offset()
+            painter.translate(offset)
+            source = event.rect().translated(-offset).intersected(self.current_image.rect())
+            painter.drawImage(source.topLeft(), self.current_image, source)
+            painter.setRenderHint(QPainter.Antialiasing)
+            self.draw_measurements(painter)
+            if self.show_changes_cb.isChecked():
+                self.draw_revision_changes(painter)
+            painter.end()
+        except Exception as e:
+            print(f"Error painting page: {str(e)}")
+
+    def load_page_render(self, page):
+        """Page view assembled from the tile cache when fully cached, else rendered and queued for caching"""
+        page_key = None
+        if self.tile_cache:
+            try:
+                bounds = (page.rect * page_view_matrix(self.scale_factor, self.orientation)).irect
+                page_key = self.tile_cache.page_key(self.current_pdf.name, self.current_page,
+                                                    self.scale_factor, self.orientation,
+                                                    self.page_render_mode(page))
+                tiles = self.tile_cache.get_page(page_key, bounds.width, bounds.height)
+                if tiles is not None:
+                    rendered = assemble_tiles(tiles, bounds.width, bounds.height,
+                                              (bounds.x0, bounds.y0), page_key[4])
+                    for _, _, tile in tiles:
+                        tile.close()
+                    return rendered
+            except OSError as e:
+                print(f"Error reading tile cache: {str(e)}")
+                page_key = None
+        
+        rendered = self.render_page(page)
+        if page_key and not rendered.alpha:
+            self.tile_cache.store_page(page_key, rendered)
+        return rendered
+
+    def page_render_mode(self, page):
+        """Resolve the selected render mode, detecting monochrome pages once in auto mode"""
+        if self.render_mode != 'auto':
+            return self.render_mode
+        if self.current_page not in self.detected_modes:
+            self.detected_modes[self.current_page] = detect_render_mode(page)
+        return self.detected_modes[self.current_page]
+
+    def change_render_mode(self, label):
+        self.render_mode = RENDER_MODES[label]
+        self.display_page()
+
+    def render_page(self, page):
+        """Render a page locally or fetch it from the render service"""
+        mode = self.page_render_mode(page)
+        if self.render_service:
+            try:
+                return self.render_service.render(self.current_pdf.name, self.current_page,
+                                                  self.scale_factor, self.orientation, mode=mode)
+            except Exception as e:
+                print(f"Render service unavailable, rendering locally: {str(e)}")
+        return render_page_data(page, self.scale_factor, self.orientation, mode=mode)
+
     def center_page_in_scroll_area(self):
         """Center the page in scroll area after zoom"""
-        if not self.current_pixmap:
+        if self.current_image is None:
             return
             
         # Get the scroll area viewport size
         viewport_size = self.scroll_area.viewport().size()
         
         # Calculate content margins to center the page
-        margin_x = max(0, (viewport_size.width() - self.current_pixmap.width()) // 2)
-        margin_y = max(0, (viewport_size.height() - self.current_pixmap.height()) // 2)
+        margin_x = max(0, (viewport_size.width() - self.current_image.width()) // 2)
+        margin_y = max(0, (viewport_size.height() - self.current_image.height()) // 2)
         
-        # Set margins to center content
+        # Set margins to center content; the label has no pixmap, so it is sized explicitly
         self.pdf_label.setContentsMargins(margin_x, margin_y, margin_x, margin_y)
+        self.pdf_label.setMinimumSize(self.current_image.width() + 2 * margin_x,
+                                      self.current_image.height() + 2 * margin_y)
         
     def zoom_in(self):
         """Zoom in with proportional calibration update"""
+        self.record_interaction('zoom', direction='in')
         try:
             ZOOM_FACTOR = 1.2
-            if self.current_pixmap:
+            if self.current_image is not None:
                 # Save current center
                 scrollbar_x = self.scroll_area.horizontalScrollBar()
                 scrollbar_y = self.scroll_area.verticalScrollBar()
                 center_x = scrollbar_x.value() + self.scroll_area.viewport().width() / 2
                 center_y = scrollbar_y.value() + self.scroll_area.viewport().height() / 2
-                rel_x = center_x / self.current_pixmap.width()
-                rel_y = center_y / self.current_pixmap.height()
+                rel_x = center_x / self.current_image.width()
+                rel_y = center_y / self.current_image.height()
                 
                 # Update scale and calibration
                 old_scale = self.scale_factor
@@ -589,14 +2262,13 @@ class QuantityEstimator(QMainWindow):
                     current_cal = self.scale_value.value()
                     new_cal = current_cal * ZOOM_FACTOR
                     self.scale_value.setValue(new_cal)
-                    self.scale_calibration *= ZOOM_FACTOR
                 
                 # Update display
                 self.display_page()
                 
                 # Restore center
-                new_x = rel_x * self.current_pixmap.width() - self.scroll_area.viewport().width() / 2
-                new_y = rel_y * self.current_pixmap.height() - self.scroll_area.viewport().height() / 2
+                new_x = rel_x * self.current_image.width() - self.scroll_area.viewport().width() / 2
+                new_y = rel_y * self.current_image.height() - self.scroll_area.viewport().height() / 2
                 scrollbar_x.setValue(int(new_x))
                 scrollbar_y.setValue(int(new_y))
                 
@@ -609,16 +2281,17 @@ class QuantityEstimator(QMainWindow):
 
     def zoom_out(self):
         """Zoom out with proportional calibration update"""
+        self.record_interaction('zoom', direction='out')
         try:
             ZOOM_FACTOR = 1/1.2
-            if self.current_pixmap:
+            if self.current_image is not None:
                 # Save current center
                 scrollbar_x = self.scroll_area.horizontalScrollBar()
                 scrollbar_y = self.scroll_area.verticalScrollBar()
                 center_x = scrollbar_x.value() + self.scroll_area.viewport().width() / 2
                 center_y = scrollbar_y.value() + self.scroll_area.viewport().height() / 2
-                rel_x = center_x / self.current_pixmap.width()
-                rel_y = center_y / self.current_pixmap.height()
+                rel_x = center_x / self.current_image.width()
+                rel_y = center_y / self.current_image.height()
                 
                 # Update scale and calibration
                 old_scale = self.scale_factor
@@ -629,14 +2302,13 @@ class QuantityEstimator(QMainWindow):
                     current_cal = self.scale_value.value()
                     new_cal = current_cal * ZOOM_FACTOR
                     self.scale_value.setValue(new_cal)
-                    self.scale_calibration *= ZOOM_FACTOR
                 
                 # Update display
                 self.display_page()
                 
                 # Restore center
-                new_x = rel_x * self.current_pixmap.width() - self.scroll_area.viewport().width() / 2
-                new_y = rel_y * self.current_pixmap.height() - self.scroll_area.viewport().height() / 2
+                new_x = rel_x * self.current_image.width() - self.scroll_area.viewport().width() / 2
+                new_y = rel_y * self.current_image.height() - self.scroll_area.viewport().height() / 2
                 scrollbar_x.setValue(int(new_x))
                 scrollbar_y.setValue(int(new_y))
                 
@@ -656,14 +2328,7 @@ class QuantityEstimator(QMainWindow):
             # Calculate new scale calibration based on current zoom level
             new_calibration = (pixels * self.scale_factor) / distance
             
-            if self.scale_calibration and self.scale_calibration > 0:
-                # Adjust existing measurements for new calibration
-                calibration_ratio = new_calibration / self.scale_calibration
-                for layer in self.layers.values():
-                    for measurement in layer.measurements:
-                        if hasattr(measurement, 'value'):
-                            measurement.value /= calibration_ratio
-                            
+            # Stored measurements pick up the new scale lazily
             self.scale_calibration = new_calibration
             self.scale_value.setValue(distance)
             
@@ -674,66 +2339,11 @@ class QuantityEstimator(QMainWindow):
             print(f"Error in calibration calculation: {str(e)}")
             self.scale_calibration = 1.0
 
-    def adjust_measurements_for_zoom(self, old_scale, new_scale):
-        """Adjust measurements when zooming"""
-        try:
-            scale_ratio = new_scale / old_scale
-            
-            # Adjust current measurement points
-            if self.measurement_points:
-                for i, point in enumerate(self.measurement_points):
-                    new_x = point.x() * scale_ratio
-                    new_y = point.y() * scale_ratio
-                    self.measurement_points[i] = QPointF(new_x, new_y)
-            
-            # Adjust all stored measurements
-            for layer in self.layers.values():
-                for measurement in layer.measurements:
-                    if hasattr(measurement, 'points') and measurement.points:
-                        # Scale the points
-                        for i, point in enumerate(measurement.points):
-                            new_x = point.x() * scale_ratio
-                            new_y = point.y() * scale_ratio
-                            measurement.points[i] = QPointF(new_x, new_y)
-                        
-                        # Update measurement value based on new points
-                        if measurement.type == "Distance" and len(measurement.points) == 2:
-                            p1, p2 = measurement.points
-                            pixels = ((p2.x() - p1.x()) ** 2 + (p2.y() - p1.y()) ** 2) ** 0.5
-                            if self.scale_calibration:
-                                measurement.value = pixels / self.scale_calibration
-                                
-                        elif measurement.type == "Area" and len(measurement.points) >= 3:
-                            area = 0
-                            points = measurement.points
-                            for i in range(len(points)):
-                                j = (i + 1) % len(points)
-                                area += points[i].x() * points[j].y()
-                                area -= points[j].x() * points[i].y()
-                            area = abs(area) / 2
-                            if self.scale_calibration:
-                                measurement.value = area / (self.scale_calibration ** 2)
-                    
-        except Exception as e:
-            print(f"Error adjusting measurements for zoom: {str(e)}")
-
     def update_calibration_scale(self, new_scale):
-        """Update calibration and adjust all measurements"""
+        """Update calibration; measurements recompute lazily from their geometry"""
         try:
             if new_scale <= 0:
                 return
-                
-            if self.scale_calibration and self.scale_calibration > 0:
-                # Calculate ratio between old and new calibration
-                scale_ratio = new_scale / self.scale_calibration
-                
-                # Update all measurements with new scale
-                for layer in self.layers.values():
-                    for measurement in layer.measurements:
-                        if measurement.type == "Distance":
-                            measurement.value *= scale_ratio
-                        elif measurement.type == "Area":
-                            measurement.value *= (scale_ratio ** 2)
             
             self.scale_calibration = new_scale
             self.display_page()
@@ -805,11 +2415,15 @@ class QuantityEstimator(QMainWindow):
         tools_layout.addWidget(orientation_group)
 
         self.measurement_type = QComboBox()
-        self.measurement_type.addItems(['None', 'Distance', 'Area', 'Count'])
+        self.measurement_type.addItems(['None', 'Distance', 'Polyline', 'Area', 'Count'])
         self.measurement_type.currentTextChanged.connect(self.change_measurement_mode)
 
+        self.area_operation = QComboBox()
+        self.area_operation.addItems(['New Area', 'Add to Area', 'Deduct from Area'])
+
         description_layout = QFormLayout()
         self.description_input = QLineEdit()
+        description_layout.addRow("Area Mode:", self.area_operation)
         description_layout.addRow("Description:", self.description_input)
 
         tools_layout.addWidget(QLabel("Measurement Type:"))
@@ -823,10 +2437,20 @@ class QuantityEstimator(QMainWindow):
         self.measurements_tree = QTreeWidget()
         self.measurements_tree.setHeaderLabels(['Type', 'Value', 'Description'])
         self.measurements_tree.setColumnCount(3)
+        self.measurements_tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
         measurements_layout.addWidget(self.measurements_tree)
         measurements_group.setLayout(measurements_layout)
         sidebar_layout.addWidget(measurements_group)
 
+        totals_group = QGroupBox("Totals")
+        totals_layout = QVBoxLayout()
+        self.totals_tree = QTreeWidget()
+        self.totals_tree.setHeaderLabels(['Group', 'Type', 'Total'])
+        self.totals_tree.setColumnCount(3)
+        totals_layout.addWidget(self.totals_tree)
+        totals_group.setLayout(totals_layout)
+        sidebar_layout.addWidget(totals_group)
+
         layer_group = QGroupBox("Layers")
         layer_layout = QVBoxLayout()
         
@@ -872,11 +2496,32 @@ class QuantityEstimator(QMainWindow):
         self.page_spin = QSpinBox()
         self.page_spin.setMinimum(1)
         self.page_spin.valueChanged.connect(self.change_page)
+        self.render_mode_combo = QComboBox()
+        self.render_mode_combo.addItems(list(RENDER_MODES))
+        self.render_mode_combo.currentTextChanged.connect(self.change_render_mode)
+        self.compare_button = QPushButton('Compare Revision')
+        self.compare_button.clicked.connect(self.compare_revision)
+        self.undo_button = QPushButton('Undo')
+        self.undo_button.clicked.connect(self.undo)
+        self.redo_button = QPushButton('Redo')
+        self.redo_button.clicked.connect(self.redo)
+        self.export_button = QPushButton('Export Markup')
+        self.export_button.clicked.connect(self.export_markup)
+        self.show_changes_cb = QCheckBox("Show Changes")
+        self.show_changes_cb.setEnabled(False)
+        self.show_changes_cb.stateChanged.connect(lambda state: self.display_page())
         toolbar.addWidget(self.load_button)
         toolbar.addWidget(self.zoom_in_button)
         toolbar.addWidget(self.zoom_out_button)
+        toolbar.addWidget(self.undo_button)
+        toolbar.addWidget(self.redo_button)
         toolbar.addWidget(QLabel("Page:"))
         toolbar.addWidget(self.page_spin)
+        toolbar.addWidget(QLabel("Render:"))
+        toolbar.addWidget(self.render_mode_combo)
+        toolbar.addWidget(self.compare_button)
+        toolbar.addWidget(self.show_changes_cb)
+        toolbar.addWidget(self.export_button)
         toolbar.addStretch()
 
         content_layout.addLayout(toolbar)
@@ -892,14 +2537,142 @@ class QuantityEstimator(QMainWindow):
         self.pdf_label.mousePressEvent = self.on_mouse_press
         self.pdf_label.mouseMoveEvent = self.on_mouse_move
         self.pdf_label.mouseReleaseEvent = self.on_mouse_release
+        self.pdf_label.paintEvent = self.paint_page
 
         content_layout.addWidget(self.scroll_area)
         main_layout.addWidget(content_widget)
 
+class InteractionRecorder:
+    """Writes timestamped interaction events to a JSON lines trace file
+
+    The file is line buffered, so a crashed or hung session keeps its trace.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'w', buffering=1)
+        self._start = time.perf_counter()
+
+    def write(self, event, **data):
+        record = {'t': round(time.perf_counter() - self._start, 6), 'event': event}
+        record.update(data)
+        self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self._file.close()
+
+def dismiss_modal_dialogs():
+    """Reject whatever modal dialog is open so replays never block on user input"""
+    dialog = QApplication.activeModalWidget()
+    if dialog is not None:
+        if hasattr(dialog, 'reject'):
+            dialog.reject()
+        else:
+            dialog.close()
+
+def replay_event(window, record):
+    """Drive a QuantityEstimator with one recorded trace event"""
+    event = record['event']
+    if event in ('press', 'move', 'release'):
+        event_type = {'press': QEvent.MouseButtonPress, 'move': QEvent.MouseMove,
+                      'release': QEvent.MouseButtonRelease}[event]
+        mouse_event = QMouseEvent(event_type, QPointF(record['x'], record['y']),
+                                  Qt.MouseButton(record['button']), Qt.MouseButtons(record['buttons']),
+                                  Qt.KeyboardModifiers(record['modifiers']))
+        QApplication.sendEvent(window.pdf_label, mouse_event)
+    elif event == 'key':
+        key_event = QKeyEvent(QEvent.KeyPress, record['key'], Qt.KeyboardModifiers(record['modifiers']))
+        QApplication.sendEvent(window, key_event)
+    elif event == 'zoom':
+        if record['direction'] == 'in':
+            window.zoom_in()
+        else:
+            window.zoom_out()
+    elif event == 'page':
+        window.page_spin.setValue(record['page'] + 1)
+    elif event == 'mode':
+        window.measurement_type.setCurrentText(record['mode'])
+    elif event == 'orientation':
+        buttons = {0: window.portrait_btn, 90: window.landscape_right_btn, -90: window.landscape_left_btn}
+        buttons[record['angle']].click()
+    elif event == 'calibrate':
+        window.start_calibration()
+    elif event == 'resize':
+        window.resize(record['width'], record['height'])
+    elif event == 'calibration':
+        # Through the setter, so the change lands in the undo history as it did when recorded
+        window.scale_calibration = record['units_per_foot'] * window.scale_factor
+
+def replay_trace(trace_path, pdf_path=None):
+    """Replay a trace offscreen and return per-event processing latencies in milliseconds
+
+    Events are replayed back to back rather than at their recorded pace, and
+    each latency covers dispatching the event plus the Qt work it queues.
+    Modal dialogs are dismissed automatically. Each replay starts with an
+    empty tile cache of its own, so runs are comparable and the user's cache
+    is left alone.
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    with tempfile.TemporaryDirectory() as tile_directory:
+        window = QuantityEstimator(tile_directory=tile_directory)
+        window.show()
+        dismiss_timer = QTimer()
+        dismiss_timer.timeout.connect(dismiss_modal_dialogs)
+        dismiss_timer.start(10)
+        
+        latencies = {}
+        with open(trace_path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['event'] == 'start':
+                    window.resize(record['width'], record['height'])
+                    app.processEvents()
+                    continue
+                if record['event'] == 'open':
+                    window.open_pdf(pdf_path or record['path'])
+                    app.processEvents()
+                    continue
+                started = time.perf_counter()
+                replay_event(window, record)
+                app.processEvents()
+                latencies.setdefault(record['event'], []).append((time.perf_counter() - started) * 1000)
+        
+        dismiss_timer.stop()
+        window.close()
+        return latencies
+
+def print_latency_report(latencies):
+    print(f"{'event':<12}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    everything = [value for values in latencies.values() for value in values]
+    for name, values in sorted(latencies.items()) + [('all', everything)]:
+        if not values:
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        print(f"{name:<12}{len(values):>8}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}{max(values):>10.2f}")
+
 def main():
-    app = QApplication(sys.argv)
-    ex = QuantityEstimator()
+    parser = argparse.ArgumentParser(description="Quantity Estimator")
+    parser.add_argument('--serve', action='store_true', help="run the local render service")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--service', metavar='URL', help="use a running render service")
+    parser.add_argument('--record', metavar='TRACE', help="record interactions to a trace file")
+    parser.add_argument('--replay', metavar='TRACE', help="replay a trace offscreen and report latencies")
+    parser.add_argument('--pdf', help="PDF to open instead of the one named in a replayed trace")
+    args, qt_args = parser.parse_known_args()
+    
+    if args.serve:
+        serve(port=args.port, workers=args.workers)
+        return
+    
+    if args.replay:
+        print_latency_report(replay_trace(args.replay, args.pdf))
+        return
+    
+    app = QApplication(sys.argv[:1] + qt_args)
+    ex = QuantityEstimator(RenderServiceClient(args.service) if args.service else None)
     ex.show()
+    if args.record:
+        ex.start_recording(args.record)
     sys.exit(app.exec_())
 
 if __name__ == '__main__':